@@ -1,7 +1,9 @@
 import matplotlib.pyplot as plt
 import numpy as np
 import copy
+import json
 import logging
+import os
 import struct
 
 
@@ -71,12 +73,16 @@ class Wave:
 
             self.get_data_foreach_channels()
 
+        # reuse the activity index saved alongside the file, if any
+        self.activity = None
+        self.load_activity(filename)
+
 
     """
     Credit: method is modified code snippet from 
     https://gist.github.com/chief7/54873e6e7009a087180902cb1f4e27be
     """
-    def save_to_file(self, filename, chan1_only): 
+    def save_to_file(self, filename, chan1_only, active_only=False): 
         data = self.data_bytes
         nchans = self.nchannels
 
@@ -84,6 +90,11 @@ class Wave:
             data = self.chan_1_data_bytes
             nchans = 1
 
+        if active_only == True:
+            # only keep the active regions, silence is stripped
+            framesize = self.dtype // 8 * nchans
+            data = b"".join(data[(start * framesize):(end * framesize)] for start, end in self.get_ranges(True))
+
         """
         Data part
         'data' - 4 bytes, header
@@ -126,6 +137,15 @@ class Wave:
             wav.write(data_header)
             wav.write(data)
 
+        nb_frames = len(data) // block_align
+        if self.activity is None:
+            # don't leave the index of a previous version of the file behind
+            self.remove_activity(filename)
+        elif active_only == True:
+            self.save_activity(filename, nb_frames, [[0, nb_frames]] if nb_frames > 0 else [])
+        else:
+            self.save_activity(filename, nb_frames)
+
 
     def plot_spectrum(self, filename, suptitle):
         assert self.nchannels == 1
@@ -149,21 +169,26 @@ class Wave:
             plt.close()
 
  
-    def plot_signal(self, filename, suptitle, chan1_only):
+    def plot_signal(self, filename, suptitle, chan1_only, active_only=False):
         nchans = self.nchannels
         if chan1_only == True:
             nchans = 1
 
-        data_1, data_2 = self.get_channels_data_int()
+        data_1, data_2 = self.get_channels_data_int(active_only)
 
         assert nchans <= 2
         assert self.dtype == 32 or self.dtype == 24 or self.dtype == 16 or self.dtype == 8
         assert nchans == 1 or len(data_1) == len(data_2)
 
-        n = len(data_1)
-        t = n // self.samplerate
-
-        xpoints = np.linspace(0, t, n);
+        # real time of each sample, with a nan between active regions so
+        # matplotlib leaves a gap where silence was skipped
+        ranges = self.get_ranges(active_only)
+        xpoints = []
+        for start, end in ranges:
+            xpoints.append(np.arange(start, end) / self.samplerate)
+            xpoints.append([np.nan])
+        xpoints = np.concatenate(xpoints[:-1]) if len(ranges) > 0 else np.array([])
+        gaps = np.cumsum([end - start for start, end in ranges], dtype=np.int64)[:-1]
 
         with plt.xkcd():
             fig, axs = plt.subplots(nchans, sharex=True, sharey=True)
@@ -180,12 +205,20 @@ class Wave:
                 ypoints_1 = np.array(data_1).astype(np.int32)
                 ypoints_2 = np.array(data_2).astype(np.int32)
 
+            ypoints_1 = np.insert(ypoints_1.astype(np.float64), gaps, np.nan)
+            ypoints_2 = np.insert(ypoints_2.astype(np.float64), gaps, np.nan)
+
             if nchans == 1:
                 axs.plot(xpoints, ypoints_1, "b", linewidth=0.2)
             else:
                 axs[0].plot(xpoints, ypoints_1, "b", linewidth=0.2)
                 axs[1].plot(xpoints, ypoints_2, "g", linewidth=0.2)
 
+            # keep the whole signal duration on the x axis, skipped silence included
+            nb_frames = self.get_ranges(False)[0][1]
+            if nb_frames > 0:
+                plt.xlim(0, nb_frames / self.samplerate)
+
             plt.xlabel("time(s)")
             plt.ylabel("amplitude")
             plt.savefig("%s" % (filename), dpi=100)
@@ -202,20 +235,24 @@ class Wave:
         print("       sample size: %s bytes" % (self.samplesize))
 
 
-    def write_and_plot(self, output_folder, filename, chan1_only=False):
+    def write_and_plot(self, output_folder, filename, chan1_only=False, active_only=False):
         filename_png = "%s.png" % (filename)
         filename_wav = "%s.wav" % (filename)
 
         print("\nwritting %s..." % filename_wav)
-        self.save_to_file("%s/%s" % (output_folder, filename_wav), chan1_only)
+        self.save_to_file("%s/%s" % (output_folder, filename_wav), chan1_only, active_only)
 
         print("plotting %s..." % filename_png)
-        self.plot_signal("%s/%s" % (output_folder, filename_png), filename, chan1_only)
+        self.plot_signal("%s/%s" % (output_folder, filename_png), filename, chan1_only, active_only)
 
 
-    def get_data_foreach_channels(self):
+    def get_data_foreach_channels(self, active_only=False):
         assert self.nchannels <= 2
 
+        if active_only == True:
+            self.update_active_data_foreach_channels()
+            return
+
         nb_samples = len(self.data_bytes) // self.samplesize
         bytes_per_sample = self.dtype // 8
         
@@ -241,24 +278,60 @@ class Wave:
         self.chan_2_data_bytes = bytes(chan_2_data_bytes_array)
 
 
+    # same as get_data_foreach_channels, but only refresh the frames of the
+    # active regions, the rest of each channel buffer is kept as is
+    def update_active_data_foreach_channels(self):
+        nb_samples = len(self.data_bytes) // self.samplesize
+
+        if self.nchannels == 1:
+            self.chan_1_data_bytes = self.data_bytes[:(nb_samples * self.samplesize)]
+            return
+
+        bytes_per_sample = self.dtype // 8
+        chan_1_data_bytes_array = bytearray(self.chan_1_data_bytes)
+        chan_2_data_bytes_array = bytearray(self.chan_2_data_bytes)
+
+        for start, end in self.get_ranges(True):
+            frames = np.frombuffer(self.data_bytes[(start * self.samplesize):(end * self.samplesize)], 
+                                   dtype=np.uint8).reshape(-1, 2, bytes_per_sample)
+            chan_offset = start * bytes_per_sample
+            chan_1_data_bytes_array[chan_offset:(end * bytes_per_sample)] = frames[:, 0, :].tobytes()
+            chan_2_data_bytes_array[chan_offset:(end * bytes_per_sample)] = frames[:, 1, :].tobytes()
+
+        self.chan_1_data_bytes = bytes(chan_1_data_bytes_array)
+        self.chan_2_data_bytes = bytes(chan_2_data_bytes_array)
+
+
     # converts channels bytes data to int and return one array for both channels
-    def get_channels_data_int(self):
+    def get_channels_data_int(self, active_only=False):
         assert self.nchannels == 1 or len(self.chan_1_data_bytes) == len(self.chan_2_data_bytes)
         chan_1_data_int = []
         chan_2_data_int = []
         byte_depth = self.dtype // 8
-        nb_samples = len(self.chan_1_data_bytes) // byte_depth
-        for sample_idx in range(nb_samples):
-            sample_offset = sample_idx * byte_depth 
-            tmpbytes = self.chan_1_data_bytes[(sample_offset):(sample_offset + byte_depth)]
-            chan_1_data_int.append(int.from_bytes(tmpbytes, byteorder="little", signed=True))
-            tmpbytes = self.chan_2_data_bytes[(sample_offset):(sample_offset + byte_depth)]
-            chan_2_data_int.append(int.from_bytes(tmpbytes, byteorder="little", signed=True))
+        for start, end in self.get_ranges(active_only):
+            for sample_idx in range(start, end):
+                sample_offset = sample_idx * byte_depth 
+                tmpbytes = self.chan_1_data_bytes[(sample_offset):(sample_offset + byte_depth)]
+                chan_1_data_int.append(int.from_bytes(tmpbytes, byteorder="little", signed=True))
+                tmpbytes = self.chan_2_data_bytes[(sample_offset):(sample_offset + byte_depth)]
+                chan_2_data_int.append(int.from_bytes(tmpbytes, byteorder="little", signed=True))
 
         return chan_1_data_int, chan_2_data_int
 
 
-    def set_bytes_from_data_int(self, dataint):
+    # frame ranges to work on, either the whole signal or only its active regions
+    def get_ranges(self, active_only):
+        if active_only == True:
+            assert self.activity is not None
+            return self.activity
+
+        nb_frames = len(self.chan_1_data_bytes) // (self.dtype // 8)
+        return [[0, nb_frames]]
+
+
+    # with active_only, dataint only holds the frames of the active regions,
+    # one after the other, and only those are written back
+    def set_bytes_from_data_int(self, dataint, active_only=False):
         assert self.nchannels == 1
 
         conv_msg = "setting bytes from data int... "
@@ -278,67 +351,58 @@ class Wave:
         if self.dtype == 8:
             from_signed = False
 
-        nb_samples = len(self.data_bytes) // self.samplesize
+        ranges = self.get_ranges(active_only)
+        nb_samples = sum(end - start for start, end in ranges)
         assert abs(len(dataint) - nb_samples) <= 1
 
         bytes_per_sample = self.dtype // 8
-        new_bytes_array = bytearray()
+        new_bytes_array = bytearray(self.data_bytes[:(len(self.data_bytes) // self.samplesize * self.samplesize)])
 
         # loop through data bytes and use new value
 
         max_val, min_val = get_max_min_from_dtype(self.dtype)
 
-        for sample_idx in range(nb_samples):
-            if (dataint[sample_idx] > max_val):
-                dataint[sample_idx] = max_val
-            elif (dataint[sample_idx] < min_val):
-                dataint[sample_idx] = min_val
+        data_idx = 0
+        for start, end in ranges:
+            for sample_idx in range(start, end):
+                if (dataint[data_idx] > max_val):
+                    dataint[data_idx] = max_val
+                elif (dataint[data_idx] < min_val):
+                    dataint[data_idx] = min_val
 
-            tmpbytes = dataint[sample_idx].to_bytes(bytes_per_sample, 'little', signed=to_signed)
-            new_bytes_array.extend(tmpbytes)
+                sample_offset = sample_idx * bytes_per_sample
+                tmpbytes = dataint[data_idx].to_bytes(bytes_per_sample, 'little', signed=to_signed)
+                new_bytes_array[sample_offset:(sample_offset + bytes_per_sample)] = tmpbytes
 
-            if sample_idx % 100000 == 0 or sample_idx == nb_samples - 1:
-                progress_bar(conv_msg, sample_idx + 1, nb_samples)
+                data_idx += 1
+                if data_idx % 100000 == 1 or data_idx == nb_samples:
+                    progress_bar(conv_msg, data_idx, nb_samples)
 
         print("")
 
         self.data_bytes = bytes(new_bytes_array)
         
         # update each channels buffer
-        self.get_data_foreach_channels()
+        self.get_data_foreach_channels(active_only)
         
         return 0
 
 
-    def filter_bandpass(self, band):
+    def filter_bandpass(self, band, active_only=False):
         print("\nfiltering bandpass range %d to %d Hz... " % (band[0], band[1]))
 
-        data_1, _ = self.get_channels_data_int()
+        # with active_only, silence is neither decoded nor written back
+        data_1, _ = self.get_channels_data_int(active_only)
 
-        spectre = np.fft.fft(data_1)
-        delta_between_measure_time_s = 1 / self.samplerate
-        freq = np.fft.fftfreq(len(data_1), delta_between_measure_time_s)
-            
-        # translate high frequency limit from Hz to index
-        # TODO use low band
-        lowfreq_filter_index = int(band[0] * len(data_1) / self.samplerate)
-        highfreq_filter_index = int(band[1] * len(data_1) / self.samplerate)
-    
-        # inspired from https://stackoverflow.com/questions/70825086/python-lowpass-filter-with-only-numpy
-        # high band
-        for i in range(highfreq_filter_index + 1, len(spectre) - highfreq_filter_index):
-            spectre[i] = 0
-
-        # low band
-        for i in range(0, lowfreq_filter_index):
-            spectre[i] = 0
+        # each active region is filtered on its own
+        signal_filtered_int = []
+        data_idx = 0
+        for start, end in self.get_ranges(active_only):
+            region = data_1[data_idx:(data_idx + end - start)]
+            signal_filtered_int.extend(bandpass_fft(region, band, self.samplerate))
+            data_idx += end - start
 
-        for i in range(len(spectre) - highfreq_filter_index, len(spectre)):
-            spectre[i] = 0
-
-        signal_filtered = np.fft.ifft(spectre)
-        signal_filtered_int = np.int_(signal_filtered.real)
-        self.set_bytes_from_data_int(signal_filtered_int.tolist())
+        self.set_bytes_from_data_int(signal_filtered_int, active_only)
 
         return 0
 
@@ -475,7 +539,7 @@ class Wave:
             return 0
 
 
-    def convert_gain(self, gain_dB):
+    def convert_gain(self, gain_dB, active_only=False):
         conv_msg = "converting with gain %ddB..." % (gain_dB)
         print("")
         print(conv_msg, end='')
@@ -493,37 +557,201 @@ class Wave:
 
         bytes_per_sample = self.dtype // 8
         nb_data = len(self.data_bytes) // bytes_per_sample
-        new_bytes_array = bytearray()
+        new_bytes_array = bytearray(self.data_bytes[:(nb_data * bytes_per_sample)])
 
         # Gain_dB = 20 log_10(out/in) => out = in * 10^(Gain_dB / 20)
         ratio = pow(10, (gain_dB / 20))
 
+        # frame ranges to data ranges, samples outside of them are left untouched
+        data_ranges = [[start * self.nchannels, end * self.nchannels] for start, end in self.get_ranges(active_only)]
+        nb_todo = sum(end - start for start, end in data_ranges)
+        nb_done = 0
+
         # loop through data bytes and convert
-        for data_idx in range(nb_data):
-            data_offset = data_idx * bytes_per_sample
+        for start, end in data_ranges:
+            for data_idx in range(start, end):
+                data_offset = data_idx * bytes_per_sample
 
-            tmpbytes = self.data_bytes[(data_offset + 0):(data_offset + bytes_per_sample)]
-            tmpint = int.from_bytes(tmpbytes, byteorder="little", signed=signed)
-            tmpint = int(tmpint * ratio)
+                tmpbytes = self.data_bytes[(data_offset + 0):(data_offset + bytes_per_sample)]
+                tmpint = int.from_bytes(tmpbytes, byteorder="little", signed=signed)
+                tmpint = int(tmpint * ratio)
 
-            if (tmpint > max_int):
-                tmpint = max_int
-            elif (tmpint < min_int):
-                tmpint = min_int
+                if (tmpint > max_int):
+                    tmpint = max_int
+                elif (tmpint < min_int):
+                    tmpint = min_int
 
-            tmpbytes = tmpint.to_bytes(bytes_per_sample, 'little', signed=signed)
-            new_bytes_array.extend(tmpbytes)
+                tmpbytes = tmpint.to_bytes(bytes_per_sample, 'little', signed=signed)
+                new_bytes_array[data_offset:(data_offset + bytes_per_sample)] = tmpbytes
 
-            if data_idx % 100000 == 0 or data_idx == nb_data - 1:
-                progress_bar(conv_msg, data_idx + 1, nb_data)
+                nb_done += 1
+                if nb_done % 100000 == 0 or nb_done == nb_todo:
+                    progress_bar(conv_msg, nb_done, nb_todo)
         
         print("")
 
         self.data_bytes = bytes(new_bytes_array)
 
+        # update each channels buffer
+        self.get_data_foreach_channels(active_only)
+
+        return 0
+
+
+    def detect_activity(self, threshold_dB=-40, block_ms=20, hangover_ms=200, 
+                        min_active_ms=100, min_silence_ms=300):
+        print("\ndetecting activity above %ddB... " % (threshold_dB), end='')
+
+        nb_frames = len(self.data_bytes) // self.samplesize
+        block_len = max(1, self.samplerate * block_ms // 1000)
+        nb_blocks = -(-nb_frames // block_len)
+        if nb_blocks == 0:
+            self.activity = []
+            print("no data")
+            return 0
+
+        """
+        /!\ When samples are represented with 8-bits, 
+            they are specified as unsigned values, centered on 128.
+            All other sample bit-sizes are specified as signed values.
+        """
+        max_val, _ = get_max_min_from_dtype(self.dtype)
+        full_scale = max_val + 1
+        if self.dtype == 8:
+            full_scale = 128
+
+        # mean energy of each block, in dB relative to full scale. Data is
+        # decoded a few blocks at a time so memory stays small on long files
+        block_dB = np.empty(nb_blocks)
+        blocks_per_slice = 64
+        for block_idx in range(0, nb_blocks, blocks_per_slice):
+            first_frame = block_idx * block_len
+            last_frame = min(first_frame + blocks_per_slice * block_len, nb_frames)
+            samples = bytes_to_samples(self.data_bytes[(first_frame * self.samplesize):(last_frame * self.samplesize)], 
+                                       self.nchannels, self.dtype)
+            if self.dtype == 8:
+                samples = samples - 128
+
+            frame_energy = np.sum(samples.astype(np.float64) ** 2, axis=1)
+            block_starts = np.arange(0, len(frame_energy), block_len)
+            block_energy = np.add.reduceat(frame_energy, block_starts)
+            block_nb_values = np.diff(np.append(block_starts, len(frame_energy))) * self.nchannels
+            block_dB[block_idx:(block_idx + len(block_starts))] = 10 * np.log10(block_energy / block_nb_values / full_scale ** 2 + 1e-12)
+
+        active = block_dB > threshold_dB
+
+        # hangover: stay active for a while after the level drops
+        hangover_blocks = hangover_ms // block_ms
+        if hangover_blocks > 0:
+            active = np.convolve(active, np.ones(hangover_blocks + 1))[:len(active)] > 0
+
+        # edges of the active runs, in blocks
+        edges = np.diff(np.concatenate(([0], active.astype(np.int8), [0])))
+        run_starts = np.flatnonzero(edges == 1)
+        run_ends = np.flatnonzero(edges == -1)
+
+        min_active = self.samplerate * min_active_ms // 1000
+        min_silence = self.samplerate * min_silence_ms // 1000
+
+        regions = []
+        for run_start, run_end in zip(run_starts, run_ends):
+            start = int(run_start) * block_len
+            end = min(int(run_end) * block_len, nb_frames)
+
+            # merge with previous region when the silence between them is too short
+            if len(regions) > 0 and start - regions[-1][1] < min_silence:
+                regions[-1][1] = end
+            else:
+                regions.append([start, end])
+
+        self.activity = [region for region in regions if region[1] - region[0] >= min_active]
+
+        nb_active = sum(end - start for start, end in self.activity)
+        print("%d active regions, %d%% of the signal" % (len(self.activity), 
+                                                          100 * nb_active // nb_frames))
+
+        return 0
+
+
+    # activity index is stored next to the wave file as json, with the
+    # number of frames it was built for to spot an index that doesn't match
+    def save_activity(self, filename, nb_frames, regions=None):
+        if regions is None:
+            regions = self.activity
+
+        with open("%s.activity.json" % (filename), "w") as f:
+            json.dump({"samplerate": self.samplerate, "nb_frames": nb_frames, 
+                       "regions": regions}, f)
+
+
+    def remove_activity(self, filename):
+        filename_activity = "%s.activity.json" % (filename)
+        if os.path.exists(filename_activity):
+            os.remove(filename_activity)
+
+
+    def load_activity(self, filename):
+        filename_activity = "%s.activity.json" % (filename)
+        if not os.path.exists(filename_activity):
+            return -1
+
+        print("read activity index %s..." % (filename_activity))
+
+        # the index is only a cache, a bad one must not prevent reading the file
+        try:
+            with open(filename_activity, "r") as f:
+                index = json.load(f)
+        except (OSError, ValueError) as e:
+            print("skipping, can't read activity index: %s" % (e))
+            return -1
+
+        if not isinstance(index, dict):
+            print("skipping, activity index is not a json object")
+            return -1
+
+        nb_frames = len(self.data_bytes) // self.samplesize
+        if index.get("samplerate") != self.samplerate or index.get("nb_frames") != nb_frames:
+            print("skipping, activity index doesn't match the file")
+            return -1
+
+        # regions must be sorted, non overlapping [start, end] frame pairs
+        regions = index.get("regions")
+        valid = isinstance(regions, list)
+        prev_end = 0
+        for region in regions if valid else []:
+            if (not isinstance(region, list) or len(region) != 2 
+                or not all(type(v) is int for v in region)
+                or not prev_end <= region[0] < region[1] <= nb_frames):
+                valid = False
+                break
+            prev_end = region[1]
+
+        if not valid:
+            print("skipping, invalid regions in activity index")
+            return -1
+
+        self.activity = regions
+
+        return 0
+
+
+    def strip_silence(self):
+        print("\nstripping silence...")
+
+        if self.activity is None:
+            print("skipping, no activity index, run detect_activity first")
+            return -1
+
+        self.data_bytes = b"".join(self.data_bytes[(start * self.samplesize):(end * self.samplesize)] 
+                                   for start, end in self.activity)
+
         # update each channels buffer
         self.get_data_foreach_channels()
 
+        # everything left is active
+        nb_frames = len(self.data_bytes) // self.samplesize
+        self.activity = [[0, nb_frames]] if nb_frames > 0 else []
+
         return 0
 
 
@@ -559,6 +787,55 @@ def get_max_min_from_dtype(dtype):
         return 2147483647, -2147483648
 
 
+def bandpass_fft(data, band, samplerate):
+    if len(data) == 0:
+        return []
+
+    spectre = np.fft.fft(data)
+
+    # translate frequency limits from Hz to index
+    lowfreq_filter_index = int(band[0] * len(data) / samplerate)
+    highfreq_filter_index = int(band[1] * len(data) / samplerate)
+
+    # inspired from https://stackoverflow.com/questions/70825086/python-lowpass-filter-with-only-numpy
+    # high band
+    for i in range(highfreq_filter_index + 1, len(spectre) - highfreq_filter_index):
+        spectre[i] = 0
+
+    # low band
+    for i in range(0, lowfreq_filter_index):
+        spectre[i] = 0
+
+    for i in range(len(spectre) - highfreq_filter_index, len(spectre)):
+        spectre[i] = 0
+
+    signal_filtered = np.fft.ifft(spectre)
+    return np.int_(signal_filtered.real).tolist()
+
+
+def bytes_to_samples(data, nchannels, dtype):
+    """
+    Decode interleaved PCM bytes into a (nb_frames, nchannels) int64 array.
+
+    /!\ When samples are represented with 8-bits,
+        they are specified as unsigned values.
+        All other sample bit-sizes are specified as signed values.
+    """
+    if dtype == 8:
+        samples = np.frombuffer(data, dtype=np.uint8)
+    elif dtype == 16:
+        samples = np.frombuffer(data, dtype="<i2")
+    elif dtype == 32:
+        samples = np.frombuffer(data, dtype="<i4")
+    else:
+        # no native 24 bits type, assemble little endian triplets by hand
+        raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        samples = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+        samples = np.where(samples & 0x800000, samples - 0x1000000, samples)
+
+    return samples.astype(np.int64).reshape(-1, nchannels)
+
+
 def bit_depth_conversion(wave):
     filename = "signal-original-%dbits-%dchan" % (wave.dtype, wave.nchannels)
     wave.write_and_plot("output/bit-depth-conversion", filename, False) # use every channels
@@ -668,6 +945,27 @@ def filter_conversion(wave):
     wave_copy2.plot_spectrum("%s/%s.png" % (folder, filename), filename) 
 
 
+def activity_detection(wave):
+    folder = "output/activity-detection"
+
+    filename = "signal-original"
+    wave.write_and_plot(folder, filename, False) # use every channels
+
+    res = wave.detect_activity(-25)
+    if res != -1:
+        # gain only where there is something to hear
+        wave_copy = copy.deepcopy(wave)
+        wave_copy.convert_gain(10, True)
+        filename = "signal-gain-10dB-active-only"
+        wave_copy.write_and_plot(folder, filename, False)
+
+        res = wave.strip_silence()
+        if res != -1:
+            wave.print_info()
+            filename = "signal-silence-stripped"
+            wave.write_and_plot(folder, filename, False)
+
+
 def main():
     # disable font warning for matplotlib
     logging.getLogger("matplotlib.font_manager").disabled = True
@@ -689,6 +987,9 @@ def main():
     wave = copy.deepcopy(wave_orig) # make a copy and keep the original
     filter_conversion(wave)
 
+    wave = copy.deepcopy(wave_orig) # make a copy and keep the original
+    activity_detection(wave)
+
 
 if __name__ == "__main__":
     main()
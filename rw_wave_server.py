@@ -0,0 +1,523 @@
+"""
+Real-time processing server.
+
+Clients connect over TCP or a Unix socket and stream audio in, either
+as a .wav (RIFF header first) or as raw PCM in the format given on the
+command line. Audio is processed block by block with the configured
+chain and streamed back in the same container as the input.
+
+Chain steps mirror the Wave methods:
+    ("gain", gain_dB)       -> Wave.convert_gain
+    ("mono",)               -> Wave.convert_to_mono
+    ("dtype", to_dtype)     -> Wave.convert_to_dtype
+    ("bandpass", [lo, hi])  -> Wave.filter_bandpass (FIR, overlap-add)
+    ("bandpass", [lo, hi], filter_ms)
+"""
+
+import numpy as np
+import argparse
+import asyncio
+import struct
+import time
+
+from rw_wave import bytes_to_samples, get_max_min_from_dtype
+
+
+class StreamFormat:
+    def __init__(self, nchannels, samplerate, dtype):
+        if nchannels != 1 and nchannels != 2:
+            raise ValueError("unsupported number of channels %d" % (nchannels))
+        if dtype != 32 and dtype != 24 and dtype != 16 and dtype != 8:
+            raise ValueError("unsupported bit depth %d" % (dtype))
+        if samplerate <= 0:
+            raise ValueError("invalid sample rate %d" % (samplerate))
+        self.nchannels = nchannels
+        self.samplerate = samplerate
+        self.dtype = dtype
+        self.samplesize = dtype // 8 * nchannels
+
+    def copy(self):
+        return StreamFormat(self.nchannels, self.samplerate, self.dtype)
+
+
+class ConnectionMetrics:
+    def __init__(self, peer):
+        self.peer = peer
+        self.start_time = time.perf_counter()
+        self.end_time = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.nb_blocks = 0
+        self.nb_frames = 0
+        self.samplerate = 0
+        self.block_frames = 0
+        self.filter_delay_frames = 0
+        self.process_time_total = 0.0
+        self.process_time_max = 0.0
+
+    def add_block(self, nb_frames, nbytes_in, nbytes_out, process_time):
+        self.nb_blocks += 1
+        self.nb_frames += nb_frames
+        self.bytes_in += nbytes_in
+        self.bytes_out += nbytes_out
+        self.process_time_total += process_time
+        self.process_time_max = max(self.process_time_max, process_time)
+
+    def close(self):
+        self.end_time = time.perf_counter()
+
+    def summary(self):
+        end_time = self.end_time if self.end_time is not None else time.perf_counter()
+        elapsed = end_time - self.start_time
+        audio_s = self.nb_frames / self.samplerate if self.samplerate else 0.0
+        avg_ms = 1000 * self.process_time_total / self.nb_blocks if self.nb_blocks else 0.0
+
+        # a frame waits for its block to be complete, then for the filters
+        # delay, before it can be sent back
+        block_ms = 1000 * self.block_frames / self.samplerate if self.samplerate else 0.0
+        filter_ms = 1000 * self.filter_delay_frames / self.samplerate if self.samplerate else 0.0
+
+        return {
+            "peer": self.peer,
+            "blocks": self.nb_blocks,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "audio_s": audio_s,
+            "elapsed_s": elapsed,
+            "buffering_ms": block_ms,
+            "filter_delay_ms": filter_ms,
+            "latency_ms": block_ms + filter_ms,
+            "latency_max_ms": block_ms + filter_ms + 1000 * self.process_time_max,
+            "process_time_avg_ms": avg_ms,
+            "process_time_max_ms": 1000 * self.process_time_max,
+            # seconds of audio processed per second of processing time
+            "realtime_factor": audio_s / self.process_time_total if self.process_time_total else 0.0,
+        }
+
+    def print_info(self):
+        s = self.summary()
+        print("")
+        print("        connection: %s" % (s["peer"]))
+        print("            blocks: %d" % (s["blocks"]))
+        print("   bytes in / out: %d / %d" % (s["bytes_in"], s["bytes_out"]))
+        print("     audio / wall: %.2f s / %.2f s" % (s["audio_s"], s["elapsed_s"]))
+        print("           latency: %.1f ms (%.1f ms block + %.1f ms filter), max %.1f ms with processing" 
+              % (s["latency_ms"], s["buffering_ms"], s["filter_delay_ms"], s["latency_max_ms"]))
+        print("   processing time: avg %.3f ms, max %.3f ms per block" % (s["process_time_avg_ms"], s["process_time_max_ms"]))
+        print("   realtime factor: %.1fx" % (s["realtime_factor"]))
+
+
+def samples_to_bytes(samples, dtype):
+    max_val, min_val = get_max_min_from_dtype(dtype)
+    samples = np.clip(samples, min_val, max_val).reshape(-1)
+
+    if dtype == 8:
+        return samples.astype(np.uint8).tobytes()
+    elif dtype == 16:
+        return samples.astype("<i2").tobytes()
+    elif dtype == 32:
+        return samples.astype("<i4").tobytes()
+    else:
+        samples = samples.astype(np.int32) & 0xFFFFFF
+        raw = np.empty((len(samples), 3), dtype=np.uint8)
+        raw[:, 0] = samples & 0xFF
+        raw[:, 1] = (samples >> 8) & 0xFF
+        raw[:, 2] = (samples >> 16) & 0xFF
+        return raw.tobytes()
+
+
+def process_gain(samples, fmt, gain_dB):
+    # Gain_dB = 20 log_10(out/in) => out = in * 10^(Gain_dB / 20)
+    ratio = pow(10, (gain_dB / 20))
+    max_int, min_int = get_max_min_from_dtype(fmt.dtype)
+    return np.clip(np.trunc(samples * ratio).astype(np.int64), min_int, max_int)
+
+
+def process_mono(samples, fmt):
+    if fmt.nchannels < 2:
+        return samples
+
+    fmt.nchannels = 1
+    fmt.samplesize = fmt.dtype // 8 * fmt.nchannels
+    return ((samples[:, 0] + samples[:, 1]) // 2).reshape(-1, 1)
+
+
+def process_dtype(samples, fmt, to_dtype):
+    if to_dtype != 32 and to_dtype != 24 and to_dtype != 16 and to_dtype != 8:
+        raise ValueError("unsupported bit depth %d" % (to_dtype))
+
+    # same as Wave.convert_to_dtype, never convert to a higher bit depth
+    if fmt.dtype <= to_dtype:
+        return samples
+
+    new_max, new_min = get_max_min_from_dtype(to_dtype)
+    old_max, old_min = get_max_min_from_dtype(fmt.dtype)
+
+    old_range = (old_max - old_min)
+    new_range = (new_max - new_min)
+
+    fmt.dtype = to_dtype
+    fmt.samplesize = fmt.dtype // 8 * fmt.nchannels
+    return (((samples - old_min) * new_range) // old_range) + new_min
+
+
+# default length of the bandpass FIR, the stream is delayed by half of it
+BANDPASS_FILTER_MS = 100
+
+
+def bandpass_taps(band, samplerate, filter_ms=BANDPASS_FILTER_MS):
+    """
+    Windowed sinc bandpass FIR. With a Blackman window the transition
+    band is about 5.5 * samplerate / ntaps wide, ~55 Hz for 100 ms.
+    Longer filters have sharper edges but add latency.
+    """
+    ntaps = samplerate * filter_ms // 1000 | 1 # odd, to have a center tap
+    n = np.arange(ntaps) - ntaps // 2
+    low = band[0] / samplerate
+    high = band[1] / samplerate
+    taps = 2 * high * np.sinc(2 * high * n) - 2 * low * np.sinc(2 * low * n)
+
+    # same level as Wave.filter_bandpass, which only keeps the positive
+    # frequencies of the spectrum and so halves the signal amplitude
+    return 0.5 * taps * np.blackman(ntaps)
+
+
+def process_bandpass(samples, fmt, band, filter_ms, state, flush):
+    """
+    Overlap-add FIR filtering: each block is convolved with the taps
+    and the part of the result past the block end (the tail) is kept
+    in state and added to the next block, so blocks join seamlessly.
+    The first ntaps // 2 output frames are dropped and given back on
+    flush, to keep the output aligned with the input.
+    """
+    if "taps" not in state:
+        state["taps"] = bandpass_taps(band, fmt.samplerate, filter_ms)
+        state["tail"] = np.zeros((len(state["taps"]) - 1, samples.shape[1]))
+        state["skip"] = len(state["taps"]) // 2
+        state["taps_spectre"] = {}
+
+    taps = state["taps"]
+    tail = state["tail"]
+    nb_frames = samples.shape[0]
+
+    if nb_frames > 0:
+        nfft = 1 << (nb_frames + len(taps) - 2).bit_length()
+        if nfft not in state["taps_spectre"]:
+            state["taps_spectre"][nfft] = np.fft.rfft(taps, nfft)[:, None]
+
+        spectre = np.fft.rfft(samples, nfft, axis=0) * state["taps_spectre"][nfft]
+        acc = np.fft.irfft(spectre, nfft, axis=0)[:(nb_frames + len(taps) - 1)]
+        acc[:len(tail)] += tail
+    else:
+        acc = tail.copy()
+
+    out = acc[:nb_frames]
+    state["tail"] = acc[nb_frames:]
+
+    # end of stream, the delayed frames are still in the tail
+    if flush:
+        out = acc[:(nb_frames + len(taps) // 2)]
+
+    skip = min(state["skip"], len(out))
+    state["skip"] -= skip
+    out = out[skip:]
+
+    return np.int_(out).astype(np.int64)
+
+
+def chain_delay_frames(chain, samplerate):
+    # frames the chain holds back, half of each bandpass FIR
+    delay = 0
+    for step in chain:
+        if step[0] == "bandpass":
+            filter_ms = step[2] if len(step) > 2 else BANDPASS_FILTER_MS
+            delay += (samplerate * filter_ms // 1000 | 1) // 2
+    return delay
+
+
+def process_block(data, fmt, chain, state=None, flush=False):
+    """
+    Run the processing chain on one block of interleaved PCM bytes.
+    fmt is updated in place to describe the output format. state keeps
+    what the steps carry from one block to the next of a same stream,
+    flush gives back what they still hold at the end of the stream.
+    """
+    if state is None:
+        state = {}
+
+    samples = bytes_to_samples(data, fmt.nchannels, fmt.dtype)
+
+    for step_idx, step in enumerate(chain):
+        name = step[0]
+        if name == "gain":
+            samples = process_gain(samples, fmt, step[1])
+        elif name == "mono":
+            samples = process_mono(samples, fmt)
+        elif name == "dtype":
+            samples = process_dtype(samples, fmt, step[1])
+        elif name == "bandpass":
+            filter_ms = step[2] if len(step) > 2 else BANDPASS_FILTER_MS
+            step_state = state.setdefault(step_idx, {})
+            samples = process_bandpass(samples, fmt, step[1], filter_ms, step_state, flush)
+        else:
+            raise ValueError("unknown processing step %s" % (name))
+
+    return samples_to_bytes(samples, fmt.dtype)
+
+
+def output_format(fmt, chain):
+    # run the chain on an empty block to learn the output format up front
+    out_fmt = fmt.copy()
+    process_block(b"", out_fmt, chain)
+    return out_fmt
+
+
+def pack_wave_header(fmt, data_len=0xFFFFFFFF):
+    """
+    Build a 44 bytes .wav header. For live streams the data length
+    is unknown, so use the maximum value as most readers accept.
+    """
+    data_header = struct.pack("<4sI", bytes("data", "utf-8"), data_len)
+
+    fmt_header = struct.pack("<4sIHHIIHH", bytes("fmt ", "utf-8"), 16, 1,
+                             fmt.nchannels, fmt.samplerate,
+                             (fmt.samplerate * fmt.dtype * fmt.nchannels) // 8,
+                             (fmt.dtype * fmt.nchannels) // 8, fmt.dtype)
+
+    filesize = min(4 + len(fmt_header) + len(data_header) + data_len, 0xFFFFFFFF)
+    riff_header = struct.pack("<4sI4s", bytes("RIFF", "utf-8"), filesize, bytes("WAVE", "utf-8"))
+
+    return riff_header + fmt_header + data_header
+
+
+# header limits, a client must not make us buffer or wait without bound
+FMT_CHUNK_MAX_LEN = 64
+SKIP_CHUNK_READ_LEN = 65536
+HEADER_TIMEOUT_S = 10
+
+
+async def read_wave_header(reader, riff):
+    """
+    Parse a .wav header from the stream, the 4 first bytes ('RIFF')
+    were already consumed. Chunks other than 'fmt ' and 'data' are skipped.
+    Return the format and the length of the data part, None when the
+    length is unknown (live streams write 0 or 0xFFFFFFFF).
+    Raise ValueError on a header we can't handle.
+    """
+    size_and_wave = await reader.readexactly(8)
+    _, wave = struct.unpack("<I4s", size_and_wave)
+    if riff != b"RIFF" or wave != b"WAVE":
+        raise ValueError("not a RIFF/WAVE header")
+
+    fmt = None
+    while True:
+        chunk_header = await reader.readexactly(8)
+        chunk_id, chunk_len = struct.unpack("<4sI", chunk_header)
+
+        if chunk_id == b"data":
+            if fmt is None:
+                raise ValueError("'data' chunk before 'fmt ' chunk")
+            if chunk_len == 0 or chunk_len == 0xFFFFFFFF:
+                return fmt, None
+            return fmt, chunk_len
+
+        if chunk_id != b"fmt ":
+            # skip unknown chunks (LIST, fact, ...) without buffering them
+            to_skip = chunk_len + (chunk_len % 2)
+            while to_skip > 0:
+                skipped = await reader.read(min(to_skip, SKIP_CHUNK_READ_LEN))
+                if not skipped:
+                    raise asyncio.IncompleteReadError(b"", to_skip)
+                to_skip -= len(skipped)
+        else:
+            if chunk_len < 16 or chunk_len > FMT_CHUNK_MAX_LEN:
+                raise ValueError("invalid 'fmt ' chunk length %d" % (chunk_len))
+            chunk = await reader.readexactly(chunk_len + (chunk_len % 2))
+            fmt_tag, nchannels, samplerate, _, _, dtype = struct.unpack("<HHIIHH", chunk[:16])
+            if fmt_tag != 1: # only PCM supported
+                raise ValueError("unsupported format tag %d, only PCM" % (fmt_tag))
+            fmt = StreamFormat(nchannels, samplerate, dtype)
+
+
+class StreamServer:
+    def __init__(self, chain, raw_fmt, block_ms=20):
+        self.chain = chain
+        self.raw_fmt = raw_fmt
+        self.block_ms = block_ms
+
+        # fail early on a bad chain instead of on the first connection
+        output_format(raw_fmt, chain)
+
+    async def handle_connection(self, reader, writer):
+        peer = writer.get_extra_info("peername") or writer.get_extra_info("sockname")
+        # printed when the connection closes, then dropped with it
+        metrics = ConnectionMetrics(str(peer))
+
+        try:
+            # a stream starting with 'RIFF' is a .wav, anything else is raw PCM
+            first = await reader.readexactly(4)
+            if first == b"RIFF":
+                fmt, remaining = await asyncio.wait_for(read_wave_header(reader, first), HEADER_TIMEOUT_S)
+                pending = b""
+                out_fmt = output_format(fmt, self.chain)
+                if remaining is None:
+                    writer.write(pack_wave_header(out_fmt))
+                else:
+                    writer.write(pack_wave_header(out_fmt, remaining // fmt.samplesize * out_fmt.samplesize))
+            else:
+                fmt = self.raw_fmt.copy()
+                remaining = None
+                pending = first
+
+            metrics.samplerate = fmt.samplerate
+
+            # block length is a whole number of frames to bound latency
+            frames_per_block = max(1, fmt.samplerate * self.block_ms // 1000)
+            block_len = frames_per_block * fmt.samplesize
+
+            metrics.block_frames = frames_per_block
+            metrics.filter_delay_frames = chain_delay_frames(self.chain, fmt.samplerate)
+
+            # what the steps carry over between blocks of this connection
+            state = {}
+
+            eof = False
+            while not eof:
+                to_read = block_len - len(pending)
+                if remaining is not None:
+                    # don't read past the data part, trailing chunks are not audio
+                    to_read = min(to_read, remaining)
+                    remaining -= to_read
+                    eof = remaining == 0
+
+                try:
+                    data = pending + await reader.readexactly(to_read)
+                except asyncio.IncompleteReadError as e:
+                    # end of stream, process what is left
+                    data = pending + e.partial
+                    eof = True
+                pending = b""
+
+                # whole frames only
+                data = data[:len(data) - len(data) % fmt.samplesize]
+
+                if len(data) == 0 and not eof:
+                    break
+
+                start = time.perf_counter()
+                block_fmt = fmt.copy()
+                out = process_block(data, block_fmt, self.chain, state, eof)
+                metrics.add_block(len(data) // fmt.samplesize, len(data), len(out),
+                                  time.perf_counter() - start)
+
+                writer.write(out)
+                await writer.drain()
+
+            if writer.can_write_eof():
+                writer.write_eof()
+
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # client left before sending a full header
+            pass
+        except ValueError as e:
+            print("\nclosing %s: %s" % (metrics.peer, e))
+        except asyncio.TimeoutError:
+            print("\nclosing %s: no complete .wav header after %d s" % (metrics.peer, HEADER_TIMEOUT_S))
+        finally:
+            metrics.close()
+            metrics.print_info()
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def start(self, host=None, port=None, unix_path=None):
+        if unix_path is not None:
+            return await asyncio.start_unix_server(self.handle_connection, path=unix_path)
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+
+async def stream_file(filename, out_filename, host=None, port=None, unix_path=None, chunk_size=4096):
+    """
+    Local test client: stream a file to the server and write back
+    whatever comes out of it.
+    """
+    if unix_path is not None:
+        reader, writer = await asyncio.open_unix_connection(unix_path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+
+    async def send():
+        with open(filename, "rb") as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                writer.write(chunk)
+                await writer.drain()
+        writer.write_eof()
+
+    async def receive():
+        with open(out_filename, "wb") as out:
+            while True:
+                chunk = await reader.read(65536)
+                if not chunk:
+                    break
+                out.write(chunk)
+
+    await asyncio.gather(send(), receive())
+    writer.close()
+
+
+def parse_chain(args):
+    chain = []
+    if args.gain is not None:
+        chain.append(("gain", args.gain))
+    if args.mono:
+        chain.append(("mono",))
+    if args.dtype is not None:
+        chain.append(("dtype", args.dtype))
+    if args.bandpass is not None:
+        chain.append(("bandpass", args.bandpass, args.filter_ms))
+    return chain
+
+
+async def serve(args):
+    raw_fmt = StreamFormat(args.channels, args.rate, args.bits)
+    server = StreamServer(parse_chain(args), raw_fmt, args.block_ms)
+    srv = await server.start(args.host, args.port, args.unix)
+
+    print("processing chain: %s" % (server.chain))
+    for sock in srv.sockets:
+        print("listening on %s" % (str(sock.getsockname())))
+
+    async with srv:
+        await srv.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="real-time .wav/PCM processing server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix", help="listen on this unix socket path instead of TCP")
+    parser.add_argument("--block-ms", type=int, default=20, help="processing block length")
+    parser.add_argument("--rate", type=int, default=44100, help="raw PCM sample rate")
+    parser.add_argument("--channels", type=int, default=2, help="raw PCM number of channels")
+    parser.add_argument("--bits", type=int, default=16, help="raw PCM bit depth")
+    parser.add_argument("--gain", type=float, help="gain in dB")
+    parser.add_argument("--mono", action="store_true", help="downmix to mono")
+    parser.add_argument("--dtype", type=int, help="convert to this bit depth")
+    parser.add_argument("--bandpass", type=int, nargs=2, metavar=("LOW", "HIGH"), help="FIR bandpass in Hz")
+    parser.add_argument("--filter-ms", type=int, default=BANDPASS_FILTER_MS, 
+                        help="bandpass filter length, sharper but more latency when longer")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()